@@ -18,40 +18,80 @@
 from __future__ import print_function
 
 import argparse
+import asyncio
+import contextlib
 import datetime
+import functools
 import glob
 import json
-import multiprocessing
 import os
 import platform
 import subprocess
 import sys
+import traceback
+
+
+# Find physical core count of the machine. This is only needed to size the
+# worker pool, so it is computed on first use rather than on import.
+@functools.lru_cache(maxsize=None)
+def detect_physical_cores():
+    if platform.system() == "Linux":
+        # Core ids are only unique within a package, so count distinct
+        # (package, core) pairs, like `lscpu --parse=core` does.
+        cores = set()
+        for topology in glob.glob(
+            "/sys/devices/system/cpu/cpu[0-9]*/topology"
+        ):
+            try:
+                with open(os.path.join(topology, "physical_package_id")) as f:
+                    package_id = f.read().strip()
+                with open(os.path.join(topology, "core_id")) as f:
+                    core_id = f.read().strip()
+            except OSError:
+                continue
+            cores.add((package_id, core_id))
+        if not cores:
+            # Some containers hide the topology in sysfs, but /proc/cpuinfo
+            # lists the same ids
+            try:
+                with open("/proc/cpuinfo") as f:
+                    package_id = None
+                    for line in f:
+                        key, _, value = line.partition(":")
+                        key = key.strip()
+                        if key == "physical id":
+                            package_id = value.strip()
+                        elif key == "core id":
+                            cores.add((package_id, value.strip()))
+            except OSError:
+                pass
+        return len(cores) or os.cpu_count()
+    elif platform.system() == "Darwin":
+        return int(subprocess.check_output(["sysctl", "-n", "hw.physicalcpu"]))
+    else:
+        raise Exception("Unknown platform: %s" % platform.system())
 
-# Find physical core count of the machine.
-if platform.system() == "Linux":
-    lines = subprocess.check_output(["lscpu", "--parse=core"])
-    physical_cores = len(
-        set(
-            line
-            for line in lines.decode("utf-8").strip().split("\n")
-            if not line.startswith("#")
-        )
-    )
-elif platform.system() == "Darwin":
-    physical_cores = int(
-        subprocess.check_output(["sysctl", "-n", "hw.physicalcpu"])
-    )
-else:
-    raise Exception("Unknown platform: %s" % platform.system())
 
-# Choose a reasonable number of application cores given the
-# available physical cores.
-app_cores = max(physical_cores - 2, 1)
+# List the Python files in a directory, skipping hidden files like glob does.
+# A missing directory yields no files.
+def find_py_files(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                os.path.join(directory, entry.name)
+                for entry in entries
+                if entry.name.endswith(".py")
+                and not entry.name.startswith(".")
+                and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
 
 # draw tests from these directories
 legate_tests = []
-legate_tests.extend(glob.glob("tests/*.py"))
-legate_tests.extend(glob.glob("examples/*.py"))
+legate_tests.extend(find_py_files("tests"))
+legate_tests.extend(find_py_files("examples"))
 
 # some test programs have additional command line arguments
 test_flags = {
@@ -59,17 +99,23 @@ test_flags = {
 }
 
 # some tests are currently disabled
-disabled_tests = [
-    "examples/kmeans_sort.py",
-    "examples/wgrad.py",
-    "tests/reduction_axis.py",
-    "examples/lstm_full.py",
-    "examples/ingest.py",
-]
-
-# filter out disabled tests
+disabled_tests = frozenset(
+    {
+        "examples/kmeans_sort.py",
+        "examples/wgrad.py",
+        "tests/reduction_axis.py",
+        "examples/lstm_full.py",
+        "examples/ingest.py",
+    }
+)
+
+# filter out disabled tests and helper scripts (e.g. tests/_server.py)
 legate_tests = sorted(
-    filter(lambda test: test not in disabled_tests, legate_tests)
+    filter(
+        lambda test: test not in disabled_tests
+        and not os.path.basename(test).startswith("_"),
+        legate_tests,
+    )
 )
 
 red = "\033[1;31m"
@@ -87,29 +133,55 @@ def load_json_config(filename):
         return None
 
 
-def cmd(command, env=None, cwd=None, stdout=None, stderr=None, show=True):
+@contextlib.contextmanager
+def patched_env(updates):
+    # Child processes inherit os.environ as is, which is cheaper than handing
+    # a full copy of the environment to every subprocess call.
+    old = {key: os.environ.get(key) for key in updates}
+    os.environ.update(updates)
+    try:
+        yield
+    finally:
+        for key, value in old.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+async def cmd(
+    command, env=None, cwd=None, stdout=None, stderr=None, show=True
+):
     if show:
         print(*command)
         sys.stdout.flush()
-    return subprocess.check_call(
-        command, env=env, cwd=cwd, stdout=stdout, stderr=stderr
+    # Don't let the tests inherit our stdin, and don't pass a preexec_fn,
+    # which would force CPython to fall back to a plain fork of this process
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        env=env,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=stdout,
+        stderr=stderr,
+        close_fds=True,
     )
+    retcode = await proc.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, command)
+    return retcode
 
 
-def run_test(
+async def run_test(
     test_file,
-    driver,
-    flags,
-    test_flags,
-    opts,
+    command,
     env,
     root_dir,
     verbose,
 ):
-    test_path = os.path.join(root_dir, test_file)
     try:
-        cmd(
-            [driver, test_path] + flags + test_flags + opts,
+        await cmd(
+            command,
             env=env,
             cwd=root_dir,
             stdout=FNULL if not verbose else sys.stderr,
@@ -121,14 +193,62 @@ def run_test(
         return False, test_file
 
 
-def report_result(test_name, result):
+async def run_batch(
+    test_files,
+    command,
+    env,
+    root_dir,
+    verbose,
+):
+    if verbose:
+        print(*command)
+        sys.stdout.flush()
+    passed, reported = set(), []
+    returncode = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            env=env,
+            cwd=root_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=FNULL if not verbose else sys.stderr,
+        )
+        tests = "".join(test_file + "\n" for test_file in test_files)
+        out, _ = await proc.communicate(tests.encode("utf-8"))
+        # The runtime and native code in the tests share this stdout, so it
+        # is not guaranteed to be valid UTF-8
+        for line in out.decode("utf-8", errors="replace").splitlines():
+            if line.startswith("PASS:"):
+                passed.add(line[len("PASS:") :])
+            if line.startswith(("PASS:", "FAIL:")):
+                reported.append(line[len("PASS:") :])
+        returncode = proc.returncode
+    except OSError:
+        return [(False, test_file) for test_file in test_files]
+    if returncode == 0:
+        return [(test_file in passed, test_file) for test_file in test_files]
+    # The server died, so the outcome of the test it was running is unknown,
+    # and so is that of the tests it never got to; the caller reruns those
+    # on their own. Since legate tasks run asynchronously, a failure can
+    # still bring the process down after the last test reported back.
+    unclear = set(test_files) - set(reported)
+    if not unclear and reported[-1] in passed:
+        unclear.add(reported[-1])
+    return [
+        (None if test_file in unclear else test_file in passed, test_file)
+        for test_file in test_files
+    ]
+
+
+def report_result(result, pass_prefix, fail_prefix):
     (passed, test_file) = result
 
     if passed:
-        print("[%sPASS%s] (%s) %s" % (green, clear, test_name, test_file))
+        print(pass_prefix + test_file)
         return 1
     else:
-        print("[%sFAIL%s] (%s) %s" % (red, clear, test_name, test_file))
+        print(fail_prefix + test_file)
         return 0
 
 
@@ -154,14 +274,16 @@ def compute_thread_pool_size_for_gpu_tests(pynvml, gpus_per_test):
 def run_test_legate(
     test_name,
     root_dir,
-    legate_dir,
+    driver,
     flags,
     env,
     verbose,
     opts,
     workers,
+    batch_size,
     num_procs,
 ):
+    pynvml = None
     if test_name == "GPU":
         try:
             import pynvml
@@ -170,92 +292,156 @@ def run_test_legate(
         except ModuleNotFoundError:
             pynvml = None
 
+    # Each GPU test gets its own set of devices, so concurrent tests only
+    # share a GPU up to the memory budget. We don't touch the device mapping
+    # if the user has already restricted the visible devices.
+    gpu_slots = None
+    if pynvml is not None and "CUDA_VISIBLE_DEVICES" not in os.environ:
+        _, parallelism = compute_thread_pool_size_for_gpu_tests(
+            pynvml, num_procs
+        )
+        gpu_count = pynvml.nvmlDeviceGetCount()
+        gpu_slots = []
+        for _ in range(max(parallelism, 1)):
+            for group in range(max(gpu_count // num_procs, 1)):
+                devices = range(group * num_procs, (group + 1) * num_procs)
+                gpu_slots.append(",".join(str(d) for d in devices))
+
     if workers is None:
         if verbose:
             workers = 1
+        elif gpu_slots is not None:
+            workers = len(gpu_slots)
         elif test_name != "GPU":
-            workers = multiprocessing.cpu_count() // num_procs
+            # Choose a reasonable number of application cores given the
+            # available physical cores.
+            app_cores = max(detect_physical_cores() - 2, 1)
+            workers = max(app_cores // num_procs, 1)
         else:
-            if pynvml is None:
-                workers = 1
-            else:
-                threads, parallelism = compute_thread_pool_size_for_gpu_tests(
-                    pynvml, num_procs
-                )
-                gpu_count = pynvml.nvmlDeviceGetCount()
-                workers = threads * num_procs // gpu_count
-
-    driver = os.path.join(legate_dir, "bin", "legate")
-    total_pass = 0
-    if workers == 1:
-        for test_file in legate_tests:
-            result = run_test(
-                test_file,
-                driver,
-                flags,
-                test_flags.get(test_file, []),
-                opts,
-                env,
-                root_dir,
-                verbose,
-            )
-            total_pass += report_result(test_name, result)
-    else:
-        # Turn off the core pinning so that the tests can run concurrently
-        env["REALM_SYNTHETIC_CORE_MAP"] = ""
-
-        pool = multiprocessing.Pool(workers)
-
-        results = []
-        for idx, test_file in enumerate(legate_tests):
-            results.append(
-                pool.apply_async(
-                    run_test,
-                    (
-                        test_file,
-                        driver,
-                        flags,
-                        test_flags.get(test_file, []),
-                        opts,
-                        env,
-                        root_dir,
-                        verbose,
-                    ),
-                )
-            )
+            workers = 1
 
-        pool.close()
+    n_tests = len(legate_tests)
 
-        result_set = set(results)
-        while True:
-            completed = set()
-            for result in result_set:
-                if result.ready():
-                    total_pass += report_result(test_name, result.get())
-                    completed.add(result)
-            result_set -= completed
-            if len(result_set) == 0:
-                break
+    if workers > 1:
+        # Turn off the core pinning so that the tests can run concurrently
+        env = dict(env, REALM_SYNTHETIC_CORE_MAP="")
+
+    if batch_size == 0:
+        # Keep one long-lived legate process per worker
+        batch_size = max(-(-n_tests // workers), 1)
+
+    # Build the command lines for all the jobs up front. Tests that need
+    # their own command line arguments always run alone.
+    server = os.path.join(root_dir, "tests", "_server.py")
+    server_command = (driver, server, *flags, *opts)
+    commands = {
+        test_file: (
+            driver,
+            os.path.join(root_dir, test_file),
+            *flags,
+            *test_flags.get(test_file, []),
+            *opts,
+        )
+        for test_file in legate_tests
+    }
+    jobs, batch = [], []
+    for test_file in legate_tests:
+        if test_file in test_flags or batch_size == 1:
+            jobs.append(([test_file], commands[test_file]))
+            continue
+        batch.append(test_file)
+        if len(batch) >= batch_size:
+            jobs.append((batch, server_command))
+            batch = []
+    if batch:
+        jobs.append((batch, server_command))
+
+    # All the work happens in the legate subprocesses, so a single event
+    # loop can keep them all busy and reap them as they finish.
+    async def run_jobs():
+        running = asyncio.Semaphore(workers)
+        devices = None
+        if gpu_slots is not None:
+            devices = asyncio.Queue()
+            for slot in gpu_slots:
+                devices.put_nowait(slot)
+
+        async def run_job(test_files, command):
+            async with running:
+                test_env = None
+                if devices is not None:
+                    slot = await devices.get()
+                    test_env = dict(os.environ, CUDA_VISIBLE_DEVICES=slot)
+                try:
+                    if command is server_command:
+                        results = await run_batch(
+                            test_files, command, test_env, root_dir, verbose
+                        )
+                        # Rerun the tests the server couldn't vouch for
+                        for idx, (passed, test_file) in enumerate(results):
+                            if passed is None:
+                                results[idx] = await run_test(
+                                    test_file,
+                                    commands[test_file],
+                                    test_env,
+                                    root_dir,
+                                    verbose,
+                                )
+                        return results
+                    return [
+                        await run_test(
+                            test_files[0], command, test_env, root_dir, verbose
+                        )
+                    ]
+                finally:
+                    if devices is not None:
+                        devices.put_nowait(slot)
+
+        async def run_one(test_files, command):
+            # Don't let a problem in one job bring down the whole stage
+            try:
+                return await run_job(test_files, command)
+            except Exception:
+                traceback.print_exc()
+                return [(False, test_file) for test_file in test_files]
+
+        pass_prefix = "[%sPASS%s] (%s) " % (green, clear, test_name)
+        fail_prefix = "[%sFAIL%s] (%s) " % (red, clear, test_name)
+        passed = 0
+        for job in asyncio.as_completed([run_one(*job) for job in jobs]):
+            for result in await job:
+                passed += report_result(result, pass_prefix, fail_prefix)
+        return passed
+
+    with patched_env(env):
+        total_pass = asyncio.run(run_jobs())
 
     print(
         "%24s: Passed %4d of %4d tests (%5.1f%%)"
         % (
             "%s" % test_name,
             total_pass,
-            len(legate_tests),
-            float(100 * total_pass) / len(legate_tests),
+            n_tests,
+            float(100 * total_pass) / n_tests,
         )
     )
     return total_pass
 
 
-def option_enabled(option, options, var_prefix="", default=True):
+def option_enabled(option, options, var_prefix="", default=True, env=None):
     if options is not None:
         return option in options
+    if env is None:
+        env = os.environ
     option_var = "%s%s" % (var_prefix, option.upper())
-    if option_var in os.environ:
-        return os.environ[option_var] == "1"
-    return default
+    return env[option_var] == "1" if option_var in env else default
+
+
+def print_banner(*lines):
+    # Emit the whole banner with a single write
+    rule = "#" * 60
+    sys.stdout.write("\n".join(("", rule) + lines + (rule, "", "")))
+    sys.stdout.flush()
 
 
 class Stage(object):
@@ -266,23 +452,15 @@ class Stage(object):
 
     def __enter__(self):
         self.begin_time = datetime.datetime.now()
-        print()
-        print("#" * 60)
-        print("### Entering Stage: %s" % self.name)
-        print("#" * 60)
-        print()
-        sys.stdout.flush()
+        print_banner("### Entering Stage: %s" % self.name)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         end_time = datetime.datetime.now()
-        print()
-        print("#" * 60)
-        print("### Exiting Stage: %s" % self.name)
-        print("###   * Exception Type: %s" % exc_type)
-        print("###   * Elapsed Time: %s" % (end_time - self.begin_time))
-        print("#" * 60)
-        print()
-        sys.stdout.flush()
+        print_banner(
+            "### Exiting Stage: %s" % self.name,
+            "###   * Exception Type: %s" % exc_type,
+            "###   * Elapsed Time: %s" % (end_time - self.begin_time),
+        )
 
 
 def run_tests(
@@ -297,17 +475,22 @@ def run_tests(
     options=[],
     interop_tests=False,
     workers=None,
+    batch_size=1,
 ):
     if interop_tests:
-        legate_tests.extend(glob.glob("tests/interop/*.py"))
+        legate_tests.extend(find_py_files("tests/interop"))
+    n_tests = len(legate_tests)
+
+    # Take a single snapshot of the environment for all the lookups below
+    environ = dict(os.environ)
 
     if root_dir is None:
         root_dir = os.path.dirname(os.path.realpath(__file__))
 
     if legate_dir is None:
         legate_config = os.path.join(root_dir, ".legate.core.json")
-        if "LEGATE_DIR" in os.environ:
-            legate_dir = os.environ["LEGATE_DIR"]
+        if "LEGATE_DIR" in environ:
+            legate_dir = environ["LEGATE_DIR"]
         elif legate_dir is None:
             legate_dir = load_json_config(legate_config)
         if legate_dir is None or not os.path.exists(legate_dir):
@@ -317,9 +500,14 @@ def run_tests(
             )
         legate_dir = os.path.realpath(legate_dir)
 
+    # Resolve the legate driver once for all the stages
+    driver_path = os.path.realpath(os.path.join(legate_dir, "bin", "legate"))
+
     # Determine which features to test with.
     def feature_enabled(feature, default=True):
-        return option_enabled(feature, use_features, "USE_", default)
+        return option_enabled(
+            feature, use_features, "USE_", default, env=environ
+        )
 
     use_eager = feature_enabled("eager", False)
     use_cuda = feature_enabled("cuda", False)
@@ -330,23 +518,20 @@ def run_tests(
         use_cpus = True
 
     # Report test suite configuration
-    print()
-    print("#" * 60)
-    print("###")
-    print("### Test Suite Configuration")
-    print("###")
-    print("### Eager NumPy fallback: %s" % use_eager)
-    print("### CPUs:                 %s" % use_cpus)
-    print("### CUDA:                 %s" % use_cuda)
-    print("### OpenMP:               %s" % use_openmp)
-    print("### Integration tests:    %s" % interop_tests)
-    print("###")
-    print("#" * 60)
-    print()
-    sys.stdout.flush()
+    print_banner(
+        "###",
+        "### Test Suite Configuration",
+        "###",
+        "### Eager NumPy fallback: %s" % use_eager,
+        "### CPUs:                 %s" % use_cpus,
+        "### CUDA:                 %s" % use_cuda,
+        "### OpenMP:               %s" % use_openmp,
+        "### Integration tests:    %s" % interop_tests,
+        "###",
+    )
 
     # Normalize the test environment.
-    env = dict(list(os.environ.items()) + [("LEGATE_TEST", "1")])
+    env = {"LEGATE_TEST": "1"}
 
     total_pass, total_count = 0, 0
     if use_eager:
@@ -354,60 +539,61 @@ def run_tests(
             count = run_test_legate(
                 "Eager",
                 root_dir,
-                legate_dir,
+                driver_path,
                 ["--cpus", "1"],
                 dict(
-                    list(env.items())
-                    + [
-                        # Set these limits high, to force eager execution
-                        ("CUNUMERIC_MIN_CPU_CHUNK", "2000000000"),
-                        ("CUNUMERIC_MIN_OMP_CHUNK", "2000000000"),
-                        ("CUNUMERIC_MIN_GPU_CHUNK", "2000000000"),
-                    ]
+                    env,
+                    # Set these limits high, to force eager execution
+                    CUNUMERIC_MIN_CPU_CHUNK="2000000000",
+                    CUNUMERIC_MIN_OMP_CHUNK="2000000000",
+                    CUNUMERIC_MIN_GPU_CHUNK="2000000000",
                 ),
                 verbose,
                 options,
                 workers,
+                batch_size,
                 1,
             )
             total_pass += count
-            total_count += len(legate_tests)
+            total_count += n_tests
     if use_cpus:
         with Stage("CPU tests"):
             count = run_test_legate(
                 "CPU",
                 root_dir,
-                legate_dir,
+                driver_path,
                 ["-cunumeric:test", "--cpus", str(cpus)],
                 env,
                 verbose,
                 options,
                 workers,
+                batch_size,
                 cpus,
             )
             total_pass += count
-            total_count += len(legate_tests)
+            total_count += n_tests
     if use_cuda:
         with Stage("GPU tests"):
             count = run_test_legate(
                 "GPU",
                 root_dir,
-                legate_dir,
+                driver_path,
                 ["-cunumeric:test", "--gpus", str(gpus)],
                 env,
                 verbose,
                 options,
                 workers,
+                batch_size,
                 gpus,
             )
             total_pass += count
-            total_count += len(legate_tests)
+            total_count += n_tests
     if use_openmp:
         with Stage("OpenMP tests"):
             count = run_test_legate(
                 "OMP",
                 root_dir,
-                legate_dir,
+                driver_path,
                 [
                     "-cunumeric:test",
                     "--omps",
@@ -419,10 +605,11 @@ def run_tests(
                 verbose,
                 options,
                 workers,
+                batch_size,
                 openmp * ompthreads,
             )
             total_pass += count
-            total_count += len(legate_tests)
+            total_count += n_tests
     print("    " + "~" * 54)
     print(
         "%24s: Passed %4d of %4d tests (%5.1f%%)"
@@ -442,15 +629,13 @@ def run_tests(
 class MultipleChoiceList(object):
     def __init__(self, *args):
         self.list = list(args)
+        self._set = frozenset(args)
 
     def __contains__(self, x):
         if type(x) is list:
-            for v in x:
-                if v not in self.list:
-                    return False
-            return True
+            return self._set.issuperset(x)
         else:
-            return x in self.list
+            return x in self._set
 
     def __iter__(self):
         return self.list.__iter__()
@@ -551,14 +736,26 @@ def driver():
     )
     parser.add_argument(
         "-j",
+        "--jobs",
         type=int,
         default=None,
         dest="workers",
         help="Number of parallel workers for testing",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        dest="batch_size",
+        help="Number of tests to run in a single Legate process "
+        "(0 runs all tests of a worker in one process)",
+    )
 
     args, opts = parser.parse_known_args()
 
+    if args.batch_size < 0:
+        parser.error("--batch-size must be non-negative")
+
     sys.exit(run_tests(options=opts, **vars(args)))
 
 
@@ -0,0 +1,53 @@
+# Copyright 2022 NVIDIA Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Runs the test programs named on stdin, one path per line, inside a single
+# legate process, so that the runtime is only initialized once. Output of
+# the tests goes to stderr; stdout only carries one PASS/FAIL line per test.
+
+import contextlib
+import os
+import runpy
+import sys
+import traceback
+
+
+def run(test_path, args):
+    # Give each test the same argv it would get from its own legate process,
+    # as cunumeric reads its flags (e.g. -cunumeric:test) from sys.argv
+    sys.argv = [test_path, *args]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(test_path)))
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            runpy.run_path(test_path, run_name="__main__")
+        return True
+    except SystemExit as e:
+        return e.code in (None, 0)
+    except Exception:
+        traceback.print_exc()
+        return False
+    finally:
+        del sys.path[0]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    for line in sys.stdin:
+        test_path = line.strip()
+        if not test_path:
+            continue
+        passed = run(test_path, args)
+        print("%s:%s" % ("PASS" if passed else "FAIL", test_path))
+        sys.stdout.flush()